@@ -70,7 +70,8 @@ Config Option explanation:
 
 
 The CONF_FAIL and CONF_RECOVER files are just a list of commands to run at either Failure or at recovery. These commands
-must be FULL commands just as if you were configuration the switch from the CLI.
+must be FULL commands just as if you were configuration the switch from the CLI. The files are read when the option
+is set and read again whenever they change on disk.
 
 For example the above referenced /mnt/flash/failed.conf file could include the following commands, which would
 shutdown the BGP neighbor on failure:
@@ -104,6 +105,10 @@ in your config change files. This is because, the EOS SDK eAPI interation module
 # Version 1.4.3 - 01/08/2023 - Python3 changes - TESTVERSION.
 # Version 1.4.4 - 03/14/2024 - change simplejson to json since simpejson removed in EOS 4.31
 # Version 1.4.5 - 04/25/2024 - Add some addtional exception logging.
+# Version 1.5.0 - 10/14/2026 - Send ICMP echo requests in-process over a raw socket instead of
+#                              forking the ping binary for every host, also inside a VRF. The
+#                              ping binary is still used as a fallback. All hosts are pinged at
+#                              once, on a worker thread so the SDK event loop is not blocked.
 #*************************************************************************************
 #
 #
@@ -115,22 +120,118 @@ in your config change files. This is because, the EOS SDK eAPI interation module
 import sys
 import syslog
 import eossdk
-import os.path
 import os
+import stat
 import json
-import re
 import subprocess as sp
 import socket
+import errno
+import select
+import struct
+import time
+import ctypes
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 __author__ = 'Jeremy Georges'
-__version__ = '1.4.5'
+__version__ = '1.5.0'
+
+# ICMP message types we care about.
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+# Payload carried in our echo requests.
+ICMP_PAYLOAD = b'PingCheck'
+
+# What ping says when the source address is not usable, e.g. the interface is down.
+CANNOT_ASSIGN = b'Cannot assign requested address'
+
+# EOS puts each VRF in its own network namespace, named ns-<vrf>.
+NETNS_PATH = '/var/run/netns/ns-%s'
+CLONE_NEWNET = 0x40000000
+LIBC = ctypes.CDLL(None, use_errno=True)
+
+#***************************
+#*     FUNCTIONS           *
+#***************************
+
+def icmp_checksum(data):
+    '''
+    RFC 1071 Internet checksum of data.
+    '''
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+def icmp_echo_request(ident, seq):
+    '''
+    Build an ICMP echo request packet with the given identifier and sequence number.
+    '''
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    checksum = icmp_checksum(header + ICMP_PAYLOAD)
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, ident, seq) + ICMP_PAYLOAD
+
+def parse_echo_reply(packet):
+    '''
+    Parse a packet read from a raw ICMP socket (IP header included).
+    Return (ident, seq) if it is an ICMP echo reply, else None.
+    '''
+    if len(packet) < 20:
+        return None
+    ihl = (packet[0] & 0x0f) * 4
+    if len(packet) < ihl + 8:
+        return None
+    icmp_type, _code, _checksum, ident, seq = struct.unpack('!BBHHH', packet[ihl:ihl + 8])
+    if icmp_type != ICMP_ECHO_REPLY:
+        return None
+    return ident, seq
+
+def setns(fd):
+    '''
+    Move the calling thread into the network namespace open on fd.
+    '''
+    if LIBC.setns(fd, CLONE_NEWNET) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+@contextlib.contextmanager
+def netns(path):
+    '''
+    Run the body with the calling thread in the network namespace at path, then
+    move it back. Sockets and processes created in there stay in that namespace,
+    so the thread only has to be in there while it creates them.
+    '''
+    with open('/proc/thread-self/ns/net') as home, open(path) as target:
+        setns(target.fileno())
+        try:
+            yield
+        finally:
+            setns(home.fileno())
 
 #***************************
 #*     CLASSES             *
 #***************************
 
-class PingCheckAgent(eossdk.AgentHandler,eossdk.TimeoutHandler, eossdk.VrfHandler):
+class PingCheckAgent(eossdk.AgentHandler,eossdk.TimeoutHandler, eossdk.VrfHandler, eossdk.FdHandler):
+    # Our options, with the label we use for each in 'show daemon' and what we show
+    # there when the option is not set. None means show the default value, which
+    # is the instance variable of the same name.
+    OPTIONSTATUS = {"IPv4": ("IPv4 Ping List:", "None"),
+                    "CONF_FAIL": ("CONF_FAIL:", "None"),
+                    "CONF_RECOVER": ("CONF_RECOVER:", "None"),
+                    "CHECKINTERVAL": ("CHECKINTERVAL:", None),
+                    "PINGCOUNT": ("PINGCOUNT:", None),
+                    "PINGTIMEOUT": ("PINGTIMEOUT:", None),
+                    "HOLDDOWN": ("HOLDDOWN:", None),
+                    "HOLDUP": ("HOLDUP:", None),
+                    "SOURCE": ("SOURCE:", "None"),
+                    "VRF": ("VRF:", "Default")}
+
     def __init__(self, sdk, timeoutMgr,VrfMgr,EapiMgr):
         self.agentMgr = sdk.get_agent_mgr()
         self.tracer = eossdk.Tracer("PingCheckPythonAgent")
@@ -141,12 +242,20 @@ class PingCheckAgent(eossdk.AgentHandler,eossdk.TimeoutHandler, eossdk.VrfHandle
         eossdk.VrfHandler.__init__(self, VrfMgr)
         self.VrfMgr = VrfMgr
         self.EapiMgr = EapiMgr
+        # The worker thread tells us a round of pings is done through this pipe.
+        eossdk.FdHandler.__init__(self)
+        self.PINGPIPE = os.pipe()
 
         # These are the defaults. The config can override these
         # Make them an instance created under __init__ .
         # Its a lot cleaner than creating global variables.
         self.SOURCEINTFADDR = None
 
+        # When we last looked up SOURCEINTFADDR, and how often (in seconds) we look
+        # it up again in case the interface was renumbered.
+        self.SOURCECHECKED = 0
+        self.SOURCEREFRESH = 60
+
         # Default number of ICMP pings to send to each host.
         self.PINGCOUNT = 2
 
@@ -161,17 +270,119 @@ class PingCheckAgent(eossdk.AgentHandler,eossdk.TimeoutHandler, eossdk.VrfHandle
 
         # Default check Interval in seconds
         self.CHECKINTERVAL = 5
+
+        # While we are GOOD and every host answered last time, only ping one in
+        # PROBESTRIDE of the hosts on each iteration, taking turns.
+        self.PROBESTRIDE = 4
+        self.PROBEROUND = 0
+
+        # How often we look at the config again while it is not usable (INACTIVE).
+        # Changing an option wakes us up straight away anyway.
+        self.INACTIVEINTERVAL = 60
         #
 
+        # Numeric options converted to int when the option is set, so we don't
+        # convert them on every iteration. Starts out with the defaults.
+        self.INTOPTIONS = {"CHECKINTERVAL": self.CHECKINTERVAL,
+                           "PINGCOUNT": self.PINGCOUNT,
+                           "PINGTIMEOUT": self.PINGTIMEOUT,
+                           "HOLDDOWN": self.HOLDDOWN,
+                           "HOLDUP": self.HOLDUP}
+
         # CURRENTSTATUS   1 is Good, 0 is Down. Use this as a flag for status.
         self.CURRENTSTATUS = 1
 
+        # Health Status we last published with status_set.
+        self.HEALTHSTATUS = None
+
+        # Last config problem check_vars told the user about, so it isn't logged
+        # again on every check.
+        self.CONFIGERROR = None
+
+        # Result of check_options, or None if an option changed since we last ran it.
+        self.OPTIONSOK = None
+
         # Global counter that we'll use between iterations
         self.ITERATION = 0
 
-        # We need a global list that will be there between iterations. Including after a reconfiguration
-        self.DEADIPV4=[]
-        self.GOODIPV4=[]
+        # We need a global status that will be there between iterations. Including after a reconfiguration
+        # Maps each host to True (up), False (down) or None (not pinged yet).
+        self.HOSTSTATUS = {}
+
+        # The IPv4 option split into a tuple of hosts. Only done when the option changes.
+        self.IPV4HOSTS = ()
+        # Entries in that list that are not valid IPv4 addresses.
+        self.BADIPV4 = []
+
+        # Commands from CONF_FAIL and CONF_RECOVER, read in when the option is set.
+        self.FAILCMDS = None
+        self.RECOVERCMDS = None
+
+        # (mtime, size) of each conf file when it was last read, so check_conf_file
+        # can tell when a file was edited and read it again.
+        self.CONFSTAT = {}
+
+        # Set to False if we can't open a raw ICMP socket (e.g. no CAP_NET_RAW), in
+        # which case we fall back to the ping binary.
+        self.RAWICMP = True
+        # Same, for opening it inside a VRF (needs CAP_SYS_ADMIN for setns).
+        self.VRFICMP = True
+        # As root we can start the ping binary in a VRF ourselves, rather than going
+        # through sudo ip netns exec. Set to False if that doesn't work out.
+        self.VRFSETNS = os.geteuid() == 0
+
+        # Our copy of the agent options, so we don't query the agent manager for each one
+        # on every iteration. Kept up to date by on_agent_option.
+        self.OPTIONS = {}
+
+        # What else needs doing when one of these options changes, besides the status.
+        self.OPTIONHANDLERS = {"IPv4": self.ipv4_option,
+                               "CONF_FAIL": self.conf_option,
+                               "CONF_RECOVER": self.conf_option,
+                               "CHECKINTERVAL": self.numeric_option,
+                               "PINGCOUNT": self.numeric_option,
+                               "PINGTIMEOUT": self.numeric_option,
+                               "HOLDDOWN": self.numeric_option,
+                               "HOLDUP": self.numeric_option,
+                               "SOURCE": self.source_option}
+
+        # Raw ICMP socket shared by all hosts, and the source address it is bound to.
+        self.ICMPSOCK = None
+        self.ICMPSOCKSOURCE = None
+        self.ICMPSOCKVRF = None
+        # Why we last failed to open it, so we only log that once. Only used by the
+        # worker thread.
+        self.ICMPSOCKERROR = None
+        # Hosts we could not send to, and why, so we only log that once. Only used by
+        # the worker thread.
+        self.SENDERRORS = {}
+
+        # ping binary command line (without the host) and the arguments it was
+        # built from, for the fallback.
+        self.PINGCMD = None
+
+        # Each host gets its own ICMP identifier when the IPv4 option is set, so
+        # replies on the shared socket can be matched back to the host.
+        # HOSTIDENT is host: ident, ICMPHOSTS is ident: (host, packed address).
+        self.HOSTIDENT = {}
+        self.ICMPHOSTS = {}
+
+        # Sequence number of the first echo request of the next iteration.
+        self.ICMPSEQ = 0
+
+        # Pings run on a single worker thread. PINGJOB is the round in progress and
+        # PINGOVERRUN is set if an iteration came around while it was still going.
+        # OPTIONGEN counts option changes and PINGJOBGEN is its value when the round
+        # was started, so we can tell if its results are stale by the time it's done.
+        # PINGJOBCONFIGOK is cleared if the config check fails while the round is going.
+        # PINGSTOP tells the worker we are shutting down, so it gives up on the round.
+        self.PINGPOOL = ThreadPoolExecutor(max_workers=1)
+        self.PINGSTOP = threading.Event()
+        self.PINGJOB = None
+        self.PINGOVERRUN = False
+        self.OPTIONGEN = 0
+        self.PINGJOBGEN = None
+        self.PINGJOBCONFIGOK = False
 
 
     def on_initialized(self):
@@ -179,132 +390,155 @@ class PingCheckAgent(eossdk.AgentHandler,eossdk.TimeoutHandler, eossdk.VrfHandle
         syslog.syslog("PingCheck Initialized")
         self.agentMgr.status_set("Status:", "Administratively Up")
 
-        # We'll pass this on to on_agent_option to process each of these.
-        self.on_agent_option("CONF_FAIL", self.agentMgr.agent_option("CONF_FAIL"))
-        self.on_agent_option("CONF_RECOVER", self.agentMgr.agent_option("CONF_RECOVER"))
-        IPv4 = self.agentMgr.agent_option("IPv4")
-        if not IPv4:
-            # No IPv4 list of IPs initially set
-            self.agentMgr.status_set("IPv4 Ping List:", "None")
-        else:
-            # Handle the initial state
-            self.on_agent_option("IPv4", IPv4)
-
-        # Lets check the extra parameters and see if we should override the defaults
-        # This is mostly for the status message.
-        if self.agentMgr.agent_option("CHECKINTERVAL"):
-            self.on_agent_option("CHECKINTERVAL", self.agentMgr.agent_option("CHECKINTERVAL"))
-        else:
-            #We'll just use the default time specified by global variable
-            self.agentMgr.status_set("CHECKINTERVAL:", "%s" % self.CHECKINTERVAL)
-
-        if self.agentMgr.agent_option("PINGCOUNT"):
-            self.on_agent_option("PINGCOUNT", self.agentMgr.agent_option("PINGCOUNT"))
-        else:
-            #We'll just use the default pingcount specified by global variable
-            self.agentMgr.status_set("PINGCOUNT:", "%s" % self.PINGCOUNT)
-
-        if self.agentMgr.agent_option("HOLDDOWN"):
-            self.on_agent_option("HOLDDOWN", self.agentMgr.agent_option("HOLDDOWN"))
-        else:
-            # We'll just use the default holddown specified by global variable
-            self.agentMgr.status_set("HOLDDOWN:", "%s" % self.HOLDDOWN)
-
-        if self.agentMgr.agent_option("HOLDUP"):
-            self.on_agent_option("HOLDUP", self.agentMgr.agent_option("HOLDUP"))
-        else:
-            # We'll just use the default holdup specified by instance of variable
-            self.agentMgr.status_set("HOLDUP:", "%s" % self.HOLDUP)
-
-        if self.agentMgr.agent_option("PINGTIMEOUT"):
-            self.on_agent_option("PINGTIMEOUT", self.agentMgr.agent_option("PINGTIMEOUT"))
-        else:
-            # We'll just use the default holddown specified by instance variable
-            self.agentMgr.status_set("PINGTIMEOUT:", "%s" % self.PINGTIMEOUT)
+        # Take a copy of all of our options and set the status for each of them.
+        # on_agent_option keeps the copy up to date, so we don't have to go back
+        # to the agent manager on every iteration. SOURCE also looks up the source
+        # interface address.
+        for optionName in self.OPTIONSTATUS:
+            self.on_agent_option(optionName, self.agentMgr.agent_option(optionName))
 
         # Some basic mandatory variable checks. We'll check this when we have a
         # no shut on the daemon. Add some notes in comment and Readme.md to
         # recommend a shut and no shut every time you make parameter changes...
 
-        self.agentMgr.status_set("Health Status:", "Unknown")
+        self.set_health_status("Unknown")
 
 
-        # Start our handler now.
+        # Start our handlers now.
+        self.watch_readable(self.PINGPIPE[0], True)
         self.timeout_time_is(eossdk.now())
 
 
     def on_agent_option(self, optionName, value):
         # options are a key/value pair
+        self.OPTIONS[optionName] = value
+
+        if optionName not in self.OPTIONSTATUS:
+            return
+
         # Here we set the status output when user does a show agent command
-        if optionName == "IPv4":
-            if not value:
-                self.tracer.trace3("IPv4 List Deleted")
-                self.agentMgr.status_set("IPv4 Ping List:", "None")
-            else:
-                self.tracer.trace3("Adding IPv4 Address list to %s" % value)
-                self.agentMgr.status_set("IPv4 Ping List:", "%s" % value)
+        statusLabel, unsetStatus = self.OPTIONSTATUS[optionName]
+        if not value:
+            self.tracer.trace3("%s Deleted" % optionName)
+            if unsetStatus is None:
+                unsetStatus = "%s" % getattr(self, optionName)
+            self.agentMgr.status_set(statusLabel, unsetStatus)
+        else:
+            self.tracer.trace3("Adding %s %s" % (optionName, value))
+            self.agentMgr.status_set(statusLabel, "%s" % value)
+
+        # And whatever else needs doing when the option changes.
+        handler = self.OPTIONHANDLERS.get(optionName)
+        if handler:
+            handler(optionName, value)
+
+        # Our options need checking again, and any round of pings in progress
+        # was started with the old ones.
+        self.OPTIONSOK = None
+        self.OPTIONGEN += 1
+
+        # If we are waiting on a config fix, check again now rather than at the
+        # next INACTIVEINTERVAL.
+        if self.HEALTHSTATUS == "INACTIVE":
+            self.timeout_time_is(eossdk.now())
 
+    def ipv4_option(self, optionName, value):
+        '''
+        Split up the IPv4 list and set up our per host state for it.
+        '''
+        if not value:
+            self.IPV4HOSTS = ()
+            self.BADIPV4 = []
+            self.HOSTSTATUS = {}
+            self.HOSTIDENT = {}
+            self.ICMPHOSTS = {}
+        else:
+            self.IPV4HOSTS = tuple(_eachip.strip() for _eachip in value.split(','))
+            # Keep the status of hosts that are still in the list.
+            self.HOSTSTATUS = dict((host, self.HOSTSTATUS.get(host)) for host in self.IPV4HOSTS)
+            self.assign_icmp_idents()
+
+    def conf_option(self, optionName, value):
+        '''
+        Read in the commands from CONF_FAIL or CONF_RECOVER.
+        '''
+        commands = self.read_config_file(value) if value else None
         if optionName == "CONF_FAIL":
-            if not value:
-                self.tracer.trace3("CONF_FAIL Deleted")
-                self.agentMgr.status_set("CONF_FAIL:", "None")
-            else:
-                self.tracer.trace3("Adding CONF_FAIL %s" % value)
-                self.agentMgr.status_set("CONF_FAIL:", "%s" % value)
-        if optionName == "CONF_RECOVER":
-            if not value:
-                self.tracer.trace3("CONF_RECOVER Deleted")
-                self.agentMgr.status_set("CONF_RECOVER:", "None")
-            else:
-                self.tracer.trace3("Adding CONF_RECOVER %s" % value)
-                self.agentMgr.status_set("CONF_RECOVER:", "%s" % value)
-        if optionName == "HOLDDOWN":
-            if not value:
-                self.tracer.trace3("HOLDDOWN Deleted")
-                self.agentMgr.status_set("HOLDDOWN:", self.HOLDDOWN)
-            else:
-                self.tracer.trace3("Adding HOLDDOWN %s" % value)
-                self.agentMgr.status_set("HOLDDOWN:", "%s" % value)
-        if optionName == "HOLDUP":
-            if not value:
-                self.tracer.trace3("HOLDUP Deleted")
-                self.agentMgr.status_set("HOLDUP:", self.HOLDUP)
-            else:
-                self.tracer.trace3("Adding HOLDUP %s" % value)
-                self.agentMgr.status_set("HOLDUP:", "%s" % value)
-        if optionName == "PINGCOUNT":
-            if not value:
-                self.tracer.trace3("PINGCOUNT Deleted")
-                self.agentMgr.status_set("PINGCOUNT:", self.PINGCOUNT)
-            else:
-                self.tracer.trace3("Adding PINGCOUNT %s" % value)
-                self.agentMgr.status_set("PINGCOUNT:", "%s" % value)
-        if optionName == "PINGTIMEOUT":
-            if not value:
-                self.tracer.trace3("PINGTIMEOUT Deleted")
-                self.agentMgr.status_set("PINGTIMEOUT:", self.PINGTIMEOUT)
-            else:
-                self.tracer.trace3("Adding PINGTIMEOUT %s" % value)
-                self.agentMgr.status_set("PINGTIMEOUT:", "%s" % value)
-        if optionName == "CHECKINTERVAL":
-            if not value:
-                self.tracer.trace3("CHECKINTERVAL Deleted")
-                self.agentMgr.status_set("CHECKINTERVAL:", self.CHECKINTERVAL)
-            else:
-                self.tracer.trace3("Adding CHECKINTERVAL %s" % value)
-                self.agentMgr.status_set("CHECKINTERVAL:", "%s" % value)
-        if optionName == "VRF":
-            if not value:
-                self.tracer.trace3("VRF Deleted")
-                self.agentMgr.status_set("VRF:", "Default")
-            else:
-                self.tracer.trace3("Adding VRF %s" % value)
-                self.agentMgr.status_set("VRF:", "%s" % value)
+            self.FAILCMDS = commands
+        else:
+            self.RECOVERCMDS = commands
+        self.CONFSTAT.pop(optionName, None)
+
+    def numeric_option(self, optionName, value):
+        '''
+        Keep the int value of a numeric option in INTOPTIONS.
+        '''
+        self.INTOPTIONS[optionName] = self.int_option(optionName, value, getattr(self, optionName))
+
+    def source_option(self, optionName, value):
+        '''
+        Look up the interface address now, rather than on every iteration.
+        '''
+        self.SOURCEINTFADDR = None
+        if value:
+            self.check_interface(value)
+
+    def int_option(self, optionName, value, default):
+        '''
+        Convert an option value to an int. Returns default if the option is not set,
+        or is not a number (and tell the user about it).
+        '''
+        if not value:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            syslog.syslog("%s value %s is not a number. Using default of %s." % (optionName, value, default))
+            return default
+
+    def assign_icmp_idents(self):
+        '''
+        Give each host in IPV4HOSTS its own ICMP identifier. They start from our PID
+        so we are unlikely to clash with anything else pinging from the switch.
+        Invalid addresses are skipped here and put in BADIPV4, check_options will
+        complain about them.
+        '''
+        self.HOSTIDENT = {}
+        self.ICMPHOSTS = {}
+        self.BADIPV4 = []
+        ident = os.getpid() & 0xffff
+        for host in self.IPV4HOSTS:
+            if host in self.HOSTIDENT:
+                continue
+            try:
+                target = socket.inet_aton(host)
+            except socket.error:
+                self.BADIPV4.append(host)
+                continue
+            self.HOSTIDENT[host] = ident
+            self.ICMPHOSTS[ident] = (host, target)
+            ident = (ident + 1) & 0xffff
+
+    def set_health_status(self, status):
+        '''
+        Set the Health Status in the agent status. This is done on every iteration,
+        so only go to the agent manager when the value actually changes.
+        '''
+        if status != self.HEALTHSTATUS:
+            self.agentMgr.status_set("Health Status:", status)
+            self.HEALTHSTATUS = status
 
     def on_agent_enabled(self, enabled):
         # When shutdown set status and then shutdown
         if not enabled:
             self.tracer.trace0("Shutting down")
+            # Don't wait for a round of pings in progress, it can take as long as
+            # PINGTIMEOUT. The worker sees PINGSTOP within a second, gives up and
+            # closes the socket itself. If nothing is running we close it here.
+            self.PINGSTOP.set()
+            self.PINGPOOL.shutdown(wait=False, cancel_futures=True)
+            if self.PINGJOB is None or self.PINGJOB.done():
+                self.close_icmp_socket()
             self.agentMgr.status_del("Status:")
             self.agentMgr.status_set("Status:", "Administratively Down")
             self.agentMgr.agent_shutdown_complete_is(True)
@@ -316,77 +550,121 @@ class PingCheckAgent(eossdk.AgentHandler,eossdk.TimeoutHandler, eossdk.VrfHandle
         0 if config is missing a key parameter and send a syslog message so user
         knows what is wrong.
         Very basic testing here. Maybe add later some syntax testing...
+        The checks that only look at our options are done by check_options, once
+        after each option change. The rest can change under us, so we do those
+        on every iteration.
         '''
-
-        # Check IP LIST.
-        if not self.agentMgr.agent_option("IPv4"):
-            syslog.syslog("IPv4 parameter is not set. This is a mandatory parameter")
+        if self.OPTIONSOK is None:
+            self.OPTIONSOK = self.check_options()
+        if not self.OPTIONSOK:
             return 0
 
-        # Parse the IPv4 list and make sure there are no typos.
-        # Let's just ask socket.inet_aton if valid.
-        if self.agentMgr.agent_option("IPv4"):
-            # Let's split this.
-            for _eachip in self.agentMgr.agent_option("IPv4").split(','):
-                try:
-                    socket.inet_aton(_eachip)
-                except socket.error:
-                    # IP is not legal.
-                    syslog.syslog("IPv4 address %s is not valid." % str(_eachip))
-                    return 0
-
-
-        # Make sure CONF file mandatory parameters are set
-        if not self.agentMgr.agent_option("CONF_FAIL"):
-            syslog.syslog("CONF_FAIL parameter is not set. This is a mandatory parameter")
-            return 0
-        if not self.agentMgr.agent_option("CONF_RECOVER"):
-            syslog.syslog("CONF_RECOVER parameter is not set. This is a mandatory parameter")
-            return 0
-
-        # If we get here, then we know our config file parameters have been setself.
-        # Now lets check to make sure the files actually exist.
-        TESTFILE=self.agentMgr.agent_option("CONF_FAIL")
-        if not os.path.isfile(TESTFILE):
-            syslog.syslog("CONF_FAIL %s does not exist. This is mandatory." % TESTFILE)
+        # Now lets check to make sure the conf files actually exist.
+        if not self.check_conf_file("CONF_FAIL"):
             return 0
-        if os.path.getsize(TESTFILE) == 0:
-            syslog.syslog("CONF_FAIL %s is blank. You need at least one command listed." % TESTFILE)
+        if not self.check_conf_file("CONF_RECOVER"):
             return 0
-        TESTFILE=self.agentMgr.agent_option("CONF_RECOVER")
-        if not os.path.isfile(TESTFILE):
-            syslog.syslog("CONF_RECOVER %s does not exist. This is mandatory." % TESTFILE)
-            return 0
-        if os.path.getsize(TESTFILE) == 0:
-            syslog.syslog("CONF_RECOVER %s is blank. You need at least one command listed." % TESTFILE)
-            return 0
-
-        # Check pingtimeout settings if it was set. Can only be 0-3600
-        if self.agentMgr.agent_option("PINGTIMEOUT"):
-            if int(self.agentMgr.agent_option("PINGTIMEOUT")) > 3600:
-                syslog.syslog("PINGTIMEOUT must not exceed 3600 seconds.")
-                return 0
 
         # Check the Source variable if it is defined..
-        if self.agentMgr.agent_option("SOURCE"):
+        if self.OPTIONS.get("SOURCE"):
             # check using eAPI module. And return the IP of interface.
             # we need to do this, because if interface is down, ping can choose
             # another interface with unknown results.
-            if self.check_interface(self.agentMgr.agent_option("SOURCE")) == False:
-                syslog.syslog("Source Interface %s is not valid. " % self.agentMgr.agent_option("SOURCE"))
+            # The address is looked up when SOURCE is set and cached in SOURCEINTFADDR.
+            # It is cleared again if the ping tells us the address is gone, so we only
+            # go back to eAPI in that case, or every SOURCEREFRESH seconds to catch
+            # a new address on the interface.
+            if (not self.SOURCEINTFADDR or eossdk.now() - self.SOURCECHECKED >= self.SOURCEREFRESH) \
+                    and self.check_interface(self.OPTIONS.get("SOURCE")) == False:
+                self.config_error("Source Interface %s is not valid. " % self.OPTIONS.get("SOURCE"))
                 return 0
 
         # If VRF option set, check to make sure it really exists.
-        if self.agentMgr.agent_option("VRF"):
-            if not self.VrfMgr.exists(self.agentMgr.agent_option("VRF")):
+        if self.OPTIONS.get("VRF"):
+            if not self.VrfMgr.exists(self.OPTIONS.get("VRF")):
                 # This means the VRF does not exist
-                syslog.syslog("VRF %s does not exist." % self.agentMgr.agent_option("VRF"))
+                self.config_error("VRF %s does not exist." % self.OPTIONS.get("VRF"))
                 return 0
 
         # If we get here, then we're good!
         #
+        self.CONFIGERROR = None
         return 1
 
+    def check_options(self):
+        '''
+        The part of check_vars that only depends on our options. Return 1 if they
+        look good, else 0 and tell the user what is wrong.
+        '''
+        # Check IP LIST.
+        if not self.OPTIONS.get("IPv4"):
+            self.config_error("IPv4 parameter is not set. This is a mandatory parameter")
+            return 0
+
+        # Make sure there are no typos in the IPv4 list. on_agent_option already
+        # asked socket.inet_aton about each address when the list was set.
+        if self.BADIPV4:
+            # IP is not legal.
+            self.config_error("IPv4 address %s is not valid." % self.BADIPV4[0])
+            return 0
+
+
+        # Make sure CONF file mandatory parameters are set
+        if not self.OPTIONS.get("CONF_FAIL"):
+            self.config_error("CONF_FAIL parameter is not set. This is a mandatory parameter")
+            return 0
+        if not self.OPTIONS.get("CONF_RECOVER"):
+            self.config_error("CONF_RECOVER parameter is not set. This is a mandatory parameter")
+            return 0
+
+        # Check pingtimeout settings if it was set. Can only be 0-3600
+        if self.OPTIONS.get("PINGTIMEOUT"):
+            if self.INTOPTIONS["PINGTIMEOUT"] > 3600:
+                self.config_error("PINGTIMEOUT must not exceed 3600 seconds.")
+                return 0
+
+        return 1
+
+    def check_conf_file(self, optionName):
+        '''
+        Make sure the file given by the CONF_FAIL or CONF_RECOVER option exists and
+        is not blank. One os.stat call gives us both, and also tells us if the file
+        was edited since we last read it.
+        '''
+        TESTFILE = self.OPTIONS.get(optionName)
+        try:
+            st = os.stat(TESTFILE)
+        except OSError as ex:
+            if ex.errno == errno.ENOENT:
+                self.config_error("%s %s does not exist. This is mandatory." % (optionName, TESTFILE))
+            else:
+                self.config_error("%s %s can not be checked: %s" % (optionName, TESTFILE, ex.strerror))
+            return False
+        if not stat.S_ISREG(st.st_mode):
+            self.config_error("%s %s does not exist. This is mandatory." % (optionName, TESTFILE))
+            return False
+        if st.st_size == 0:
+            self.config_error("%s %s is blank. You need at least one command listed." % (optionName, TESTFILE))
+            return False
+        fileStat = (st.st_mtime_ns, st.st_size)
+        if optionName in self.CONFSTAT and self.CONFSTAT[optionName] != fileStat:
+            self.tracer.trace3("%s %s changed, reading it again" % (optionName, TESTFILE))
+            if optionName == "CONF_FAIL":
+                self.FAILCMDS = self.read_config_file(TESTFILE)
+            else:
+                self.RECOVERCMDS = self.read_config_file(TESTFILE)
+        self.CONFSTAT[optionName] = fileStat
+        return True
+
+    def config_error(self, message):
+        '''
+        Tell the user what is wrong with the config. check_vars runs on every
+        iteration, so only log it when the problem is not the one we logged last.
+        '''
+        if message != self.CONFIGERROR:
+            syslog.syslog(message)
+            self.CONFIGERROR = message
+
     def on_timeout(self):
         '''
          This is the function/method where we do the exciting stuff :-)
@@ -420,99 +698,64 @@ class PingCheckAgent(eossdk.AgentHandler,eossdk.TimeoutHandler, eossdk.VrfHandle
             # as versatile. What happens if remote rate limits pings so we have
             # a false positive? This is why we need to make sure that all our
             # hosts in our list are down before we consider this an issue.
-            # Lets test each host in list and then we will populate DEAD or GOOD
-            # global list. Then it is easier to do our logic or change it after
+            # Lets test each host in list and then we will populate its status in
+            # HOSTSTATUS. Then it is easier to do our logic or change it after
             # all the checks.
 
-            IPv4 = self.agentMgr.agent_option("IPv4")
-            if IPv4:
-                EachAddress = IPv4.split(',')
-                for host in EachAddress:
-                    pingstatus = self.pingDUT(str(host))
-                    # After ping status, lets go over all the various test cases below
-                    if pingstatus == True:
-                        # Its alive - UP
-                        # Check to see if it was in our dead list
-                        if host in self.DEADIPV4:
-                            #Notify that its back up.
-                            syslog.syslog('PingCheck host %s is back up' % str(host))
-                            self.DEADIPV4.remove(host)
-                        if host not in self.GOODIPV4:
-                            self.GOODIPV4.append(host)
-                    else:
-                        # Its not alive  - DOWN
-                        if host not in self.DEADIPV4:
-                            syslog.syslog('PingCheck host %s is down' % str(host))
-                            self.DEADIPV4.append(host)
-                        if host in self.GOODIPV4:
-                        	# need to remove it from our GOOD list.
-                            self.GOODIPV4.remove(host)
-
-            # We need to have some local variables to use for HOLDUP and
-            # HOLDDOWN because the admin might change the values from the
-            # default. So lets just check this on each iteration.
-            # But if the admin changes this in the middle of an interation
-            # check, we should make sure ITERATION is greater than or equal
-            # to the HOLDDOWN or HOLDUP values so we don't get stuck.
-
-            if self.agentMgr.agent_option("HOLDDOWN"):
-                HOLDDOWNLOCAL = self.agentMgr.agent_option("HOLDDOWN")
-            else:
-                HOLDDOWNLOCAL = self.HOLDDOWN
-            if self.agentMgr.agent_option("HOLDUP"):
-                HOLDUPLOCAL = self.agentMgr.agent_option("HOLDUP")
-            else:
-                HOLDUPLOCAL = self.HOLDUP
-
-			# Now we have all the ping state for each host. Lets do our
-            # additional logic here
-            # Current implementaion is logical OR. So all we need is at least
-            # one host in GOODIPV4 list and we pass
-            if len(self.GOODIPV4) > 0:
-            	# We have some life here...now we need to determine whether to
-                # recover or not based on our HOLDDOWN.
-                if self.CURRENTSTATUS == 0:
-                	#We were down, now determine if we should recover yet.
-                    if self.ITERATION >= int(HOLDDOWNLOCAL):
-                    	# Recover
-                        self.CURRENTSTATUS = 1
-                        self.ITERATION = 0
-                        syslog.syslog("PingCheck Recovering. Changing configure for recovered state.")
-                        # RUN CONFIG Change
-                        self.change_config('RECOVER')
-                    else:
-                        self.ITERATION += 1
-                        # We need to wait till we hit our HOLDDOWN counter so
-                        # we dampen a flapping condition if so exists
-            else:
-            	# We get here when everything is down...nothing in GOODIPV4 list
-                # Determine, are we already down? If so, noop. If not, then we
-                # need to determine if we are at HOLDDOWN.
-                if self.CURRENTSTATUS == 1:
-                	# Determine if we need to do something
-                    if self.ITERATION >= int(HOLDUPLOCAL):
-                        syslog.syslog("PingCheck Failure State. Changing configuration for failed state")
-                        # run config change failure
-                        self.change_config('FAIL')
-                        #Set Currentstatus to 0, we're now in failed state
-                        self.CURRENTSTATUS = 0
-                        #Reset ITERATION
-                        self.ITERATION = 0
-                    else:
-                        self.ITERATION += 1
-
-            # Set current state via HealthStatus with agentMgr.
-            if self.CURRENTSTATUS == 1:
-                self.agentMgr.status_set("Health Status:", "GOOD")
+            # The pings run on a worker thread, so the SDK event loop isn't blocked
+            # while we wait for replies and agent options or a shutdown can still
+            # be handled. When they are done, on_readable picks up the results.
+            if self.PINGJOB is None:
+                # Since this is a logical OR, when we are GOOD and every host was up
+                # last time, one reply from any host is all we need to stay GOOD, so
+                # we don't need to send to all of them. Take turns pinging a slice of
+                # the list. We wait for the whole slice, so every host gets measured
+                # within PROBESTRIDE iterations. Once one of them goes down, not every
+                # host is up any more and the next iteration pings them all again.
+                # When we are in FAIL state, the first host to answer is all we need
+                # to start counting towards HOLDDOWN, and the rest are picked up once
+                # we have recovered.
+                # Otherwise we wait for all of them, so we can see individual hosts
+                # come and go.
+                steady = self.CURRENTSTATUS == 1 and all(self.HOSTSTATUS.values())
+                firstreply = self.CURRENTSTATUS == 0
+                hosts = self.IPV4HOSTS
+                if steady:
+                    stride = min(self.PROBESTRIDE, len(hosts))
+                    self.PROBEROUND = (self.PROBEROUND + 1) % stride
+                    hosts = hosts[self.PROBEROUND::stride]
+                pingcount = self.INTOPTIONS["PINGCOUNT"]
+                pingtimeout = self.INTOPTIONS["PINGTIMEOUT"]
+                # The worker must not call into the SDK, so work out the VRF here.
+                if self.VrfMgr.exists(self.OPTIONS.get("VRF")):
+                    vrf = self.OPTIONS.get("VRF")
+                else:
+                    vrf = None
+                # Same for the ICMP identifiers. on_agent_option replaces these as the
+                # IPv4 list changes, so hand the worker its own copy for this round.
+                targets = dict((self.HOSTIDENT[host], self.ICMPHOSTS[self.HOSTIDENT[host]])
+                               for host in hosts if host in self.HOSTIDENT)
+                self.PINGJOB = self.PINGPOOL.submit(self.pingHosts, hosts, targets, pingcount,
+                                                    pingtimeout, self.SOURCEINTFADDR, vrf, firstreply)
+                self.PINGJOBGEN = self.OPTIONGEN
+                self.PINGJOBCONFIGOK = True
+                self.PINGJOB.add_done_callback(self.ping_done)
             else:
-                self.agentMgr.status_set("Health Status:", "FAIL")
+                # The last round of pings is still going. Go again as soon as it's done.
+                self.PINGOVERRUN = True
 
         else:
             # If we failed the config check, then we land here and just skip any other processing
             # and set Health status to INACTIVE.
             # Once the config checks out, then we'll change it above with either GOOD or FAIL
             # dependent on our ping checks.
-            self.agentMgr.status_set("Health Status:", "INACTIVE")
+            # Nothing will change until the config does, and on_agent_option wakes us
+            # up when it does, so there is no need to keep checking every CHECKINTERVAL.
+            # If a round of pings is still going, its results mustn't undo this.
+            self.PINGJOBCONFIGOK = False
+            self.set_health_status("INACTIVE")
+            self.timeout_time_is(eossdk.now() + self.INACTIVEINTERVAL)
+            return
 
         # Wait for CHECKINTERVAL - if memory serves, I think I added this is to deal with
         # time drift especially if many of the pings timeout and PINGTIMEOUT is set to a
@@ -521,20 +764,141 @@ class PingCheckAgent(eossdk.AgentHandler,eossdk.TimeoutHandler, eossdk.VrfHandle
         # If the delta between the time we started our interation to this point of
         # execution, then we need to go through our checks again immediately.
         # If all is good, runTime ends up being pretty close to zero for the most part.
-        runTime = eossdk.now() - startTime
-        if self.agentMgr.agent_option("CHECKINTERVAL"):
-            if runTime > int(self.agentMgr.agent_option("CHECKINTERVAL")):
-                self.timeout_time_is(eossdk.now()) # Run now if Checkinterval shorter than run time.
-            else:
-                nextRun = int(self.agentMgr.agent_option("CHECKINTERVAL")) - runTime
-                self.timeout_time_is(eossdk.now() + nextRun)
+        # The pings themselves run on the worker thread now, so a round of pings that
+        # takes longer than CHECKINTERVAL is handled with PINGOVERRUN in on_readable.
+        endTime = eossdk.now()
+        runTime = endTime - startTime
+        CHECKINTERVAL = self.INTOPTIONS["CHECKINTERVAL"]
+        if runTime > CHECKINTERVAL:
+            self.timeout_time_is(endTime) # Run now if Checkinterval shorter than run time.
         else:
-            if runTime > int(self.CHECKINTERVAL):
-                self.timeout_time_is(eossdk.now())
+            nextRun = CHECKINTERVAL - runTime
+            self.timeout_time_is(endTime + nextRun)
+
+
+    def ping_done(self, job):
+        '''
+        Called on the worker thread when a round of pings is done. We can't touch
+        the SDK from here, so just wake up the SDK event loop through our pipe.
+        '''
+        os.write(self.PINGPIPE[1], b'.')
+
+    def on_readable(self, fd):
+        '''
+        The worker thread finished a round of pings. Pick up the results and do
+        our state handling back on the SDK event loop.
+        '''
+        os.read(fd, 512)
+        job = self.PINGJOB
+        if job is None or not job.done():
+            return
+        self.PINGJOB = None
+        try:
+            pingresults, sourcegone = job.result()
+        except Exception as ex:
+            # We should not be here....
+            syslog.syslog("Error trying to ping: %s" % str(ex))
+        else:
+            if sourcegone:
+                # Look the source address up again on the next iteration.
+                self.SOURCEINTFADDR = None
+            if self.PINGJOBGEN != self.OPTIONGEN:
+                # The options changed while we were pinging, so these results may be
+                # for the wrong hosts or settings. Drop them and go again now.
+                self.tracer.trace3("Options changed during ping round, discarding results")
+                self.PINGOVERRUN = True
+            elif not self.PINGJOBCONFIGOK:
+                # The config check failed while we were pinging and on_timeout has
+                # set us INACTIVE. Leave it at that until the config is fixed.
+                self.tracer.trace3("Config check failed during ping round, discarding results")
+            elif self.OPTIONS.get("VRF") and not self.VrfMgr.exists(self.OPTIONS.get("VRF")):
+                # The VRF went away under us, so the hosts look down when they may
+                # not be. Don't act on the results then. on_timeout has already
+                # checked the rest of the config for this round, and the next
+                # iteration checks it all again and says what is wrong.
+                self.set_health_status("INACTIVE")
             else:
-                nextRun = int(self.CHECKINTERVAL) - runTime
-                self.timeout_time_is(eossdk.now() + nextRun)
+                self.update_status(pingresults)
+
+        # If we skipped an iteration while waiting for this, run again now.
+        if self.PINGOVERRUN:
+            self.PINGOVERRUN = False
+            self.timeout_time_is(eossdk.now())
 
+    def update_status(self, pingresults):
+        '''
+        Go over the ping results for each host, then decide whether we need to
+        fail or recover.
+        '''
+        if not pingresults:
+            # We didn't get to ping anyone this round, so we know no more than we
+            # did last time. Don't count it towards HOLDUP or HOLDDOWN.
+            return
+        for host in self.IPV4HOSTS:
+            if host not in pingresults:
+                # Skipped this time around.
+                continue
+            pingstatus = pingresults[host]
+            prevstatus = self.HOSTSTATUS.get(host)
+            self.HOSTSTATUS[host] = pingstatus
+            # We only need to say something when the status flips. If we
+            # couldn't tell this time, the worker has already said why.
+            if pingstatus is not None and pingstatus != prevstatus:
+                if pingstatus:
+                    # Its alive - UP
+                    # Notify that its back up, if it was down before.
+                    if prevstatus is not None:
+                        syslog.syslog('PingCheck host %s is back up' % host)
+                else:
+                    # Its not alive  - DOWN
+                    syslog.syslog('PingCheck host %s is down' % host)
+
+        # Now we have all the ping state for each host. Lets do our
+        # additional logic here
+        # Current implementaion is logical OR. So all we need is at least
+        # one host up in HOSTSTATUS and we pass
+        # If that is different from where we are now, work towards changing state.
+        # Going from FAIL to GOOD waits out HOLDDOWN, so we dampen a flapping
+        # condition if so exists. Going from GOOD to FAIL waits out HOLDUP.
+        # on_agent_option keeps INTOPTIONS up to date with those.
+        # Hosts we have no status for right now don't count either way.
+        known = [status for status in self.HOSTSTATUS.values() if status is not None]
+        if not known:
+            return
+        newstatus = 1 if any(known) else 0
+        if newstatus != self.CURRENTSTATUS:
+            if newstatus == 1:
+                self.hold_state(newstatus, self.INTOPTIONS["HOLDDOWN"])
+            else:
+                self.hold_state(newstatus, self.INTOPTIONS["HOLDUP"])
+
+        # Set current state via HealthStatus with agentMgr.
+        if self.CURRENTSTATUS == 1:
+            self.set_health_status("GOOD")
+        else:
+            self.set_health_status("FAIL")
+
+    def hold_state(self, newstatus, hold):
+        '''
+        Our hosts say we should be in newstatus (1 is Good, 0 is Down), and we are
+        not. Count iterations until we get to hold (HOLDDOWN or HOLDUP), then change
+        state and apply the config for it.
+        If the admin changes hold in the middle of this, ITERATION may already be
+        past it. We check for greater than or equal so we don't get stuck.
+        '''
+        if self.ITERATION < hold:
+            self.ITERATION += 1
+            return
+        self.CURRENTSTATUS = newstatus
+        self.ITERATION = 0
+        if newstatus == 1:
+            syslog.syslog("PingCheck Recovering. Changing configure for recovered state.")
+            # RUN CONFIG Change
+            self.change_config('RECOVER')
+        else:
+            syslog.syslog("PingCheck Failure State. Changing configuration for failed state")
+            # run config change failure
+            self.change_config('FAIL')
 
     def check_interface(self,SOURCE):
         """
@@ -544,137 +908,401 @@ class PingCheckAgent(eossdk.AgentHandler,eossdk.TimeoutHandler, eossdk.VrfHandle
         # Use EapiMgr to show interfaces and we'll make sure this
         # interface is ok to use.
         # Should we worry about capitalizing first char?
+        ipaddr = ''
         try:
             showint = self.EapiMgr.run_show_cmd("show ip interface %s" % SOURCE)
             interfaceID = json.loads(showint.responses()[0])
             for item in interfaceID['interfaces'].keys():
                 ipaddr = interfaceID['interfaces'][item]['interfaceAddress']['primaryIp']['address']
-        except:
+        except Exception as ex:
+            # No such interface, no address on it, or eAPI had a problem.
+            self.tracer.trace3("Unable to get address of %s: %s" % (SOURCE, str(ex)))
             ipaddr = ''
         if ipaddr:
+            if ipaddr != self.SOURCEINTFADDR:
+                syslog.syslog("Source Interface %s and Src IP %s will be used." % (SOURCE, ipaddr))
             self.SOURCEINTFADDR = ipaddr
+            self.SOURCECHECKED = eossdk.now()
             return ipaddr
         else:
+            self.SOURCEINTFADDR = None
             return False
 
-    def pingDUT(self,hostname):
+    def pingHosts(self, hosts, targets, pingcount, pingtimeout, source, vrf, firstreply=False):
         """
-        Ping a DUT(s).
+        Ping a list of DUT(s) all at the same time.
+
+        ICMP echo requests are sent in-process over a single raw socket, so we don't
+        fork and exec the ping binary for each host on every iteration. All hosts are
+        pinged concurrently, so an iteration takes about as long as pinging one host.
+        With a VRF the socket is opened in the VRF's network namespace, and we only
+        fall back to the ping binary if we are not allowed to do that.
+        Returns a dict of host: True if the host answered at least one echo request,
+        same as ping's return code, or None if we can't tell, and whether the source
+        address turned out to be gone so it needs looking up again.
+
+        If firstreply is set, we stop as soon as one host answers. Hosts we didn't
+        hear from by then are left out of the result rather than reported down.
+        Hosts we couldn't ping at all because of a problem on our side are left
+        out too.
+        The ping binary fallback always waits for every host.
+
+        This runs on the worker thread, so everything it needs is passed in and it
+        must not call into the SDK or change any state the SDK thread uses. targets
+        is ident: (host, packed address) for the hosts with an ICMP identifier,
+        source is the source interface address and vrf the VRF name, either can be
+        None.
         """
+        if not self.RAWICMP or (vrf and not self.VRFICMP):
+            return self.pingHostsSubprocess(hosts, pingcount, pingtimeout, source, vrf)
 
-        # Create a list of commands for subprocess Popen
-        vrf_commands = ['sudo','ip','netns','exec']
-        commands = ['ping']
+        try:
+            sock = self.icmp_socket(source, vrf)
+        except socket.error as ex:
+            # Same hint as the ping binary case below.
+            if ex.errno == errno.EADDRNOTAVAIL:
+                syslog.syslog("%s. Interface is probably down." % str(ex))
+                return dict((host, False) for host in hosts), True
+            if ex.errno not in (errno.EPERM, errno.EACCES):
+                # Something that can come and go, e.g. the VRF's namespace isn't
+                # there yet while the VRF is being created. Skip this round and
+                # try again on the next one.
+                if self.ICMPSOCKERROR != ex.errno:
+                    syslog.syslog("Unable to open raw ICMP socket: %s" % str(ex))
+                    self.ICMPSOCKERROR = ex.errno
+                return {}, False
+            # We are not allowed to, and that won't change.
+            if vrf:
+                syslog.syslog("Unable to open raw ICMP socket in VRF %s, using ping binary instead. %s" % (vrf, str(ex)))
+                self.VRFICMP = False
+            else:
+                syslog.syslog("Unable to open raw ICMP socket, using ping binary instead. %s" % str(ex))
+                self.RAWICMP = False
+            return self.pingHostsSubprocess(hosts, pingcount, pingtimeout, source, vrf)
+        self.ICMPSOCKERROR = None
 
-        # Set our ping count parameter.
-        if self.agentMgr.agent_option("PINGCOUNT"):
-            commands.append('-c%s' % self.agentMgr.agent_option("PINGCOUNT"))
-        else:
-            commands.append('-c%s' % str(self.PINGCOUNT))
+        try:
+            return self.icmp_ping(sock, targets, pingcount, pingtimeout, firstreply), False
+        except socket.error as ex:
+            if self.PINGSTOP.is_set():
+                return {}, False
+            # Our socket is broken, which says nothing about the hosts. Skip this
+            # round and open a new socket on the next one.
+            syslog.syslog("Error trying to ping: %s" % str(ex))
+            sock.close()
+            if self.ICMPSOCK is sock:
+                self.ICMPSOCK = None
+            return {}, False
+        finally:
+            if self.PINGSTOP.is_set():
+                self.close_icmp_socket()
+
+    def close_icmp_socket(self):
+        """
+        Close the raw ICMP socket, if we have one open.
+        """
+        sock = self.ICMPSOCK
+        self.ICMPSOCK = None
+        if sock is not None:
+            sock.close()
 
-        # Set our ping timeout parameter.
-        if self.agentMgr.agent_option("PINGTIMEOUT"):
-            commands.append('-W%s' % self.agentMgr.agent_option("PINGTIMEOUT"))
-        else:
-            commands.append('-W%s' % str(self.PINGTIMEOUT))
-
-        if self.SOURCEINTFADDR:
-            _intf='-I%s' % self.SOURCEINTFADDR
-            commands.append(_intf)
-        if self.VrfMgr.exists(self.agentMgr.agent_option("VRF")):
-            #EOS prepends vrf with ns- in Kernel name space.
-            kernel_vrf = 'ns-' + str(self.agentMgr.agent_option("VRF"))
-            vrf_commands.append(kernel_vrf)
-            fullping_command = vrf_commands + commands + [hostname]
+    def icmp_socket(self, source, vrf=None):
+        """
+        Return the raw ICMP socket shared by all hosts, bound to the source
+        interface address if SOURCE is set, and opened in the VRF's network
+        namespace if VRF is set. It is kept open between iterations and only
+        reopened when the source address or VRF changes.
+        """
+        if self.ICMPSOCK is not None and self.ICMPSOCKSOURCE == source and self.ICMPSOCKVRF == vrf:
+            return self.ICMPSOCK
+        if self.ICMPSOCK is not None:
+            self.ICMPSOCK.close()
+            self.ICMPSOCK = None
+        if vrf:
+            with netns(NETNS_PATH % vrf):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
         else:
-            fullping_command = commands + [hostname]
+            sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        if source:
+            try:
+                sock.bind((source, 0))
+            except socket.error:
+                sock.close()
+                raise
+        # Non-blocking so icmp_ping can read every queued reply after one select.
+        sock.setblocking(False)
+        self.ICMPSOCK = sock
+        self.ICMPSOCKSOURCE = source
+        self.ICMPSOCKVRF = vrf
+        return sock
+
+    def icmp_ping(self, sock, targets, pingcount, pingtimeout, firstreply=False):
+        """
+        Send pingcount echo requests to each host in targets, one per second like the
+        ping binary, and wait up to pingtimeout seconds after the last one for replies.
+        Every host has its own ICMP identifier so we can tell the replies apart
+        on the shared socket. With firstreply, return as soon as one host answers.
+        """
+        results = {}
+        pending = dict(targets)
 
-        try:
-            ping_host = sp.Popen(fullping_command,stdout=sp.PIPE,stderr=sp.PIPE)
-            output, err = ping_host.communicate()
-        except:
-            # We should not be here....
-            syslog.syslog("Error trying to execute ping")
-            syslog.syslog("Ping output: %s" % output)
-
-        if err != '':
-            # We get here in error conditions such as interface is not available
-            # e.g. interface is not in the vrf specified. We'll log it so user
-            # has a hint of what might be the issue. Otherwise, if we just return
-            # a value, it will not be clear. If the interface is down, the same error
-            # will occur.
-
-            # Let's provide a more useful error message.
-            # Python3 changed the behavior here. so lets force to a string.
-            if re.match('Cannot assign requested address', str(err)):
-                syslog.syslog("%s. Interface is probably down." % str(err))
-                return False
-
-        if ping_host.returncode == 0:
-            # Ping is good
-            return True
-        else:
-            return False
+        # Each iteration uses its own range of sequence numbers, so a late reply
+        # to an earlier iteration is not taken as an answer to this one.
+        seqbase = self.ICMPSEQ
+        self.ICMPSEQ = (seqbase + pingcount) & 0xffff
 
+        # Throw away any replies that showed up after the last iteration gave up.
+        while True:
+            try:
+                sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                break
+
+        seq = 0
+        now = time.monotonic()
+        nextSend = now
+        deadline = now + (pingcount - 1) + pingtimeout
+        while pending and not self.PINGSTOP.is_set():
+            if seq < pingcount and now >= nextSend:
+                failed = []
+                for ident, (host, _target) in pending.items():
+                    try:
+                        sock.sendto(icmp_echo_request(ident, (seqbase + seq) & 0xffff), (host, 0))
+                    except BlockingIOError:
+                        # Send buffer is full, this host just misses this round.
+                        pass
+                    except socket.error as ex:
+                        if ex.errno in (errno.EBADF, errno.ENOTSOCK):
+                            # The socket itself is broken, that's everyone.
+                            raise
+                        # Something about this host, e.g. no route to it (more likely
+                        # inside a VRF) or a broadcast address. It can't answer, but
+                        # that's no reason to give up on the others.
+                        if self.SENDERRORS.get(host) != ex.errno:
+                            syslog.syslog("Unable to ping %s: %s" % (host, ex.strerror))
+                            self.SENDERRORS[host] = ex.errno
+                        failed.append(ident)
+                    else:
+                        self.SENDERRORS.pop(host, None)
+                for ident in failed:
+                    results[pending.pop(ident)[0]] = False
+                seq += 1
+                nextSend = now + 1
+            if now >= deadline:
+                break
+            wait = deadline - now
+            if seq < pingcount:
+                wait = min(wait, nextSend - now)
+            # Look at PINGSTOP at least once a second, even with a long PINGTIMEOUT.
+            wait = min(wait, 1)
+            if select.select([sock], [], [], wait)[0]:
+                # With many hosts the replies arrive in bursts, so read all of
+                # them before going back to select.
+                while pending:
+                    try:
+                        packet, addr = sock.recvfrom(1024)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    reply = parse_echo_reply(packet)
+                    if reply and reply[0] in pending and (reply[1] - seqbase) & 0xffff < pingcount:
+                        host, target = pending[reply[0]]
+                        if socket.inet_aton(addr[0]) == target:
+                            results[host] = True
+                            del pending[reply[0]]
+                            if firstreply:
+                                return results
+            now = time.monotonic()
+        for host, _target in pending.values():
+            results[host] = False
+        return results
+
+    def pingHostsSubprocess(self, hosts, pingcount, pingtimeout, source, vrf):
+        """
+        Ping a list of DUT(s) with the ping binary. One ping process is started per
+        host and they all run at the same time. Takes the same arguments as pingHosts,
+        less targets, and returns the same.
+        """
 
+        # A process started while this thread is in the VRF's namespace runs in the
+        # VRF too, so if we can do that we don't need sudo ip netns exec.
+        setnsvrf = bool(vrf) and self.VRFSETNS
+
+        # The command is the same for every host apart from the address at the end,
+        # and only changes with the options, so build it once and keep it.
+        pingargs = (pingcount, pingtimeout, source, vrf, setnsvrf)
+        if self.PINGCMD is None or self.PINGCMD[0] != pingargs:
+            # Create a list of commands for subprocess Popen
+            vrf_commands = ['sudo','ip','netns','exec']
+            commands = ['ping']
+
+            # Set our ping count parameter.
+            commands.append('-c%s' % pingcount)
+
+            # Set our ping timeout parameter.
+            commands.append('-W%s' % pingtimeout)
+
+            if source:
+                _intf='-I%s' % source
+                commands.append(_intf)
+            if vrf and not setnsvrf:
+                #EOS prepends vrf with ns- in Kernel name space.
+                kernel_vrf = 'ns-' + str(vrf)
+                vrf_commands.append(kernel_vrf)
+                commands = vrf_commands + commands
+            self.PINGCMD = (pingargs, commands)
+        commands = self.PINGCMD[1]
+
+        # Start all of the pings first, then collect them.
+        if setnsvrf:
+            try:
+                with netns(NETNS_PATH % vrf):
+                    running = self.start_pings(commands, hosts)
+            except OSError as ex:
+                syslog.syslog("Unable to enter VRF %s, using ip netns exec instead. %s" % (vrf, str(ex)))
+                self.VRFSETNS = False
+                return self.pingHostsSubprocess(hosts, pingcount, pingtimeout, source, vrf)
+        else:
+            running = self.start_pings(commands, hosts)
+
+        # ping should be done after pingcount - 1 seconds of sending plus pingtimeout
+        # for the last reply. Give it a good margin on top, since all of the pings
+        # start at once and sudo and netns exec can be slow on a busy supervisor,
+        # but don't let a hung ping hold up the whole iteration past that.
+        deadline = time.monotonic() + pingcount + pingtimeout + max(2, pingtimeout)
+        results = {}
+        killed = []
+        sourcegone = False
+        for hostname in hosts:
+            if hostname not in running:
+                # We couldn't start the ping, so we don't know about this host.
+                continue
+            ping_host = running[hostname]
+            # ping only writes a line or two to stderr, so it can't fill the pipe
+            # and we can just wait for it. Only read stderr if the ping failed.
+            # Wait a second at a time, so we can give up when we are shutting down.
+            try:
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if self.PINGSTOP.is_set():
+                        raise sp.TimeoutExpired(ping_host.args, 0)
+                    try:
+                        ping_host.wait(timeout=max(0, min(1, remaining)))
+                        break
+                    except sp.TimeoutExpired:
+                        if remaining <= 1:
+                            raise
+            except sp.TimeoutExpired:
+                ping_host.kill()
+                ping_host.wait()
+                ping_host.stderr.close()
+                # We don't know whether it would have got a reply, so don't call the
+                # host down. Don't let it keep its last status either, or a ping that
+                # hangs every time would keep us GOOD on that host alone.
+                results[hostname] = None
+                killed.append(hostname)
+                continue
+            if ping_host.returncode == 0:
+                # Ping is good
+                ping_host.stderr.close()
+                results[hostname] = True
+                continue
+            err = ping_host.stderr.read()
+            ping_host.stderr.close()
+
+            if err:
+                # We get here in error conditions such as interface is not available
+                # e.g. interface is not in the vrf specified. We'll log it so user
+                # has a hint of what might be the issue. Otherwise, if we just return
+                # a value, it will not be clear. If the interface is down, the same error
+                # will occur.
+
+                # Let's provide a more useful error message.
+                # stderr is bytes, so look for the message as bytes and only decode
+                # it when we log it.
+                if CANNOT_ASSIGN in err:
+                    syslog.syslog("%s. Interface is probably down." % err.decode(errors='replace').strip())
+                    sourcegone = True
+
+            results[hostname] = False
+        if killed and not self.PINGSTOP.is_set():
+            syslog.syslog("Pings to %s did not finish in time, killed them." % ', '.join(killed))
+        return results, sourcegone
+
+
+
+    def start_pings(self, commands, hosts):
+        """
+        Start a ping process for each host with the given command line. Returns a
+        dict of host: Popen for the ones that started.
+        """
+        running = {}
+        for hostname in hosts:
+            try:
+                # We only look at the return code and stderr, so don't bother piping stdout.
+                running[hostname] = sp.Popen(commands + [hostname],stdout=sp.DEVNULL,stderr=sp.PIPE)
+            except Exception as ex:
+                # We should not be here....
+                syslog.syslog(syslog.LOG_ERR, "Error trying to execute ping: %s" % str(ex))
+        return running
+
+    def read_config_file(self, CONFFILE):
+        '''
+        Read one of our CONF_FAIL/CONF_RECOVER files and return the list of commands
+        in it, ready for run_config_cmds. Returns None if the file can't be read.
+        '''
+        try:
+            with open(CONFFILE) as fh:
+                # Strip out the whitespace and skip blank lines as we read the file.
+                configfile = [x for x in (line.strip() for line in fh) if x]
+        except IOError as ex:
+            self.tracer.trace3("Unable to read %s: %s" % (CONFFILE, str(ex)))
+            return None
+
+        # Check to make sure user has not specified 'enable' as the first command. This will error  in config mode
+        if configfile and configfile[0] == 'enable':
+            del configfile[0]
+        return configfile
 
     def change_config(self, STATUS):
         '''
         Method to change configuration of switch.
         If STATUS is FAIL, then run CONF_FAIL via eAPI API
         If STATUS RECOVER (or else) then run CONF_RECOVER via eAPI API
+        The commands were already read in by on_agent_option, so there is no file I/O
+        here unless that failed.
         '''
-        CONF_FAIL = self.agentMgr.agent_option("CONF_FAIL")
-        CONF_RECOVER = self.agentMgr.agent_option("CONF_RECOVER")
         if STATUS == 'FAIL':
             self.tracer.trace0("Status FAIL. Applying config changes")
-            with open(CONF_FAIL) as fh:
-                configfile = fh.readlines()
-            # Strip out the whitespace
-            configfile = [x.strip() for x in configfile]
-
-            # Check to make sure user has not specified 'enable' as the first command. This will error  in config mode
-            if configfile[0] == 'enable':
-                del configfile[0]
-            # Now apply config changes
-            try:
-                applyconfig = self.EapiMgr.run_config_cmds([z for z in configfile])
-                if applyconfig.success():
-                    syslog.syslog("Applied Configuration changes from %s" % CONF_FAIL)
-                else:
-                    syslog.syslog("Unable to apply configuration changes from %s" % CONF_FAIL)
-                    # provide some details on what error there was with configuration
-                    syslog.syslog("%s" % applyconfig.error_message())
-            except Exception as ex:
-                # Log why we got the exception.
-                syslog.syslog("Unable to apply config via eAPI interaction module in EOS SDK.")
-                syslog.syslog(str(ex))
-                return 0
+            CONFFILE = self.OPTIONS.get("CONF_FAIL")
+            if self.FAILCMDS is None:
+                self.FAILCMDS = self.read_config_file(CONFFILE)
+            configfile = self.FAILCMDS
         else:
             self.tracer.trace0("Status Recover. Applying config changes.")
-            with open(CONF_RECOVER) as fh:
-                configfile = fh.readlines()
-            # Strip out the whitespace
-            configfile = [x.strip() for x in configfile]
+            CONFFILE = self.OPTIONS.get("CONF_RECOVER")
+            if self.RECOVERCMDS is None:
+                self.RECOVERCMDS = self.read_config_file(CONFFILE)
+            configfile = self.RECOVERCMDS
 
-            # Check to make sure user has not specified 'enable' as the first command. This will error  in config mode
-            if configfile[0] == 'enable':
-                del configfile[0]
+        if not configfile:
+            syslog.syslog("Unable to apply configuration changes from %s. No commands found." % CONFFILE)
+            return 0
 
-            # Now apply config changes
-            try:
-                applyconfig = self.EapiMgr.run_config_cmds([z for z in configfile])
-                if applyconfig.success():
-                    syslog.syslog("Applied Configuration changes from %s" % CONF_RECOVER)
-                else:
-                    syslog.syslog("Unable to apply configuration changes from %s" % CONF_RECOVER)
-                    # provide some details on what error there was with configuration
-                    syslog.syslog("%s" % applyconfig.error_message())
-            except Exception as ex:
-                # Log why we got the exception.
-                syslog.syslog("Unable to apply config via eAPI interaction module in EOS SDK.")
-                syslog.syslog(str(ex))
-                return 0
+        # Now apply config changes
+        try:
+            applyconfig = self.EapiMgr.run_config_cmds(configfile)
+            if applyconfig.success():
+                syslog.syslog("Applied Configuration changes from %s" % CONFFILE)
+            else:
+                # provide some details on what error there was with configuration,
+                # in the same message so it can't get separated from it in the log.
+                syslog.syslog(syslog.LOG_ERR, "Unable to apply configuration changes from %s: %s"
+                              % (CONFFILE, applyconfig.error_message()))
+        except Exception as ex:
+            # Log why we got the exception.
+            syslog.syslog(syslog.LOG_ERR, "Unable to apply config via eAPI interaction module in EOS SDK: %s"
+                          % str(ex))
+            return 0
 
         return 1
 
@@ -684,6 +1312,9 @@ class PingCheckAgent(eossdk.AgentHandler,eossdk.TimeoutHandler, eossdk.VrfHandle
 def main():
     syslog.openlog(ident="PingCheck-ALERT-AGENT",logoption=syslog.LOG_PID, facility=syslog.LOG_LOCAL4)
     sdk = eossdk.Sdk()
+    # Keep a reference to the agent. The SDK only holds on to the C++ side of our
+    # handlers, so without this the Python object would be freed before main_loop
+    # ever calls it.
     PingCheck = PingCheckAgent(sdk, sdk.get_timeout_mgr(),sdk.get_vrf_mgr(),sdk.get_eapi_mgr())
     sdk.main_loop(sys.argv)
     # Run the agent until terminated by a signal